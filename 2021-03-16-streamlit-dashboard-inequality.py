@@ -1,183 +1,218 @@
 # Create streamlit dashboard with data about inequality and relative poverty
 
 # Modules
+import json
+import logging
+from types import MappingProxyType
 import pandas as pd
-import requests
-from pyjstat import pyjstat
 import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
+from plotly.utils import PlotlyJSONEncoder
 import streamlit as st
+from streamlit.logger import get_logger
+from statbank_pipeline import (Source, Transform, run, query_indkomst_kommuner,
+                               query_pct_lavindkomst_kommuner, query_n_lavindkomst_kommuner)
 
 # Import data from dst
 
-## URL to DST's API
-url_dst = 'https://api.statbank.dk/v1/data'
-
-## Parameters for the API
-query_indkomst_kommuner = {
-   "table": "IFOR32",
-   "format": "JSONSTAT",
-   "valuePresentation": "CodeAndValue",
-   "variables": [
-      {
-         "code": "DECILGEN",
-         "values": [
-            "*"
-         ]
-      },
-      {
-         "code": "KOMMUNEDK",
-         "values": [
-            "*"
-         ]
-      },
-      {
-         "code": "Tid",
-         "values": [
-            "(-n+10)"
-         ]
-      }
-   ]
-}
-
-query_pct_lavindkomst_kommuner = {
-   "table": "IFOR12P",
-   "format": "JSONSTAT",
-   "valuePresentation": "CodeAndValue",
-   "variables": [
-      {
-         "code": "KOMMUNEDK",
-         "values": [
-            "*"
-         ]
-      },
-      {
-         "code": "INDKN",
-         "values": [
-            "50"
-         ]
-      },
-      {
-         "code": "Tid",
-         "values": [
-            "(-n+10)"
-         ]
-      }
-   ]
-}
-
-query_n_lavindkomst_kommuner = {
-   "table": "IFOR12A",
-   "format": "JSONSTAT",
-   "valuePresentation": "CodeAndValue",
-   "variables": [
-      {
-         "code": "KOMMUNEDK",
-         "values": [
-            "*"
-         ]
-      },
-      {
-         "code": "INDKN",
-         "values": [
-            "50"
-         ]
-      },
-      {
-         "code": "Tid",
-         "values": [
-            "(-n+10)"
-         ]
-      }
-   ]
-}
-
-query_folketal = {
-   "table": "FOLK1A",
-   "format": "JSONSTAT",
-   "valuePresentation": "CodeAndValue",
-   "variables": [
-      {
-         "code": "OMRÅDE",
-         "values": [
-            "*"
-         ]
-      },
-      {
-         "code": "Tid",
-         "values": [
-            "*K1"
-         ]
-      },
-      {
-         "code": "Tid",
-         "values": [
-            "(-n+10)"
-         ]
-      }
-   ]
-}
-
-## Post query
-r_indkomst_kommuner = requests.post(url_dst, json = query_indkomst_kommuner)
-
-r_pct_lavindkomst_kommuner = requests.post(url_dst, json = query_pct_lavindkomst_kommuner)
-
-r_n_lavindkomst_kommuner = requests.post(url_dst, json = query_n_lavindkomst_kommuner)
-
-r_folketal = requests.post(url_dst, json = query_folketal)
-
-## Read JSON-stat result
-ds_indkomst_kommuner = pyjstat.Dataset.read(r_indkomst_kommuner.text)
-
-ds_pct_lavindkomst_kommuner = pyjstat.Dataset.read(r_pct_lavindkomst_kommuner.text)
-
-ds_n_lavindkomst_kommuner = pyjstat.Dataset.read(r_n_lavindkomst_kommuner.text)
-
-ds_folketal = pyjstat.Dataset.read(r_folketal.text)
-
-## Write to pandas dataframe
-df_indkomst_kommuner = ds_indkomst_kommuner.write('dataframe', naming = 'label')
-
-df_pct_lavindkomst_kommuner = ds_pct_lavindkomst_kommuner.write('dataframe', naming = 'label')
-
-df_n_lavindkomst_kommuner = ds_n_lavindkomst_kommuner.write('dataframe', naming = 'label')
-
-df_folketal_tekst = ds_folketal.write('dataframe', naming = 'label')
-df_folketal_kode = ds_folketal.write('dataframe', naming = 'id')
-df_folketal_tekst['id'] = df_folketal_kode['OMRÅDE']
-
-# Data cleaning and wrangling
-kun_kommuner = df_indkomst_kommuner["kommune"] != "Hele landet"
-regioner = df_indkomst_kommuner["kommune"].map(lambda x: x.startswith('Region'))
-
-df_kommuner_g_indkomst = (df_indkomst_kommuner
-   .loc[(kun_kommuner) & (~regioner), ["decil gennemsnit", "kommune", "tid", "value"]]
-   .rename(columns = {'tid': 'year',
-                      'decil gennemsnit': 'decile_group',
-                      'value': 'avg_income',
-                      'kommune': 'municipality_name'})
-)
+## Fetch and wrangle the data once per process
+## The data is shared by every session, so the arrays are made read-only instead of
+## letting st.cache hash (or copy) the dataframes on each rerun. Each rerun works on a
+## shallow copy of the shared frames (see below), so adding, replacing or dropping
+## columns only changes the frame of that rerun
+def freeze(df):
+    """Make the arrays backing a dataframe read-only, so a session cannot modify shared data.
+
+    Only numpy arrays can be made read-only, so columns with an extension dtype
+    (categorical, nullable integers etc.) are left as they are.
+    """
+    ## _consolidate_inplace and _mgr are pandas internals, as of the pinned pandas 1.2
+    df._consolidate_inplace()
+    for block in df._mgr.blocks:
+        if isinstance(block.values, np.ndarray):
+            block.values.flags.writeable = False
+    return df
+
+def row_positions(df, column):
+    """Read-only mapping from each value in a column to the positions of its rows.
+
+    Comparing a read-only text column with == fails in pandas, and is a scan of every
+    row anyway, so sessions look up the rows of a municipality here instead.
+    """
+    positions = df.groupby(column).indices
+    for rows in positions.values():
+        rows.flags.writeable = False
+    return MappingProxyType(positions)
+
+## Data cleaning and wrangling
+## The queries only fetch municipalities (see statbank_pipeline.py)
+
+## Municipalities, keyed on their StatBank code
+def wrangle_kommuner(df_indkomst_kommuner):
+    return (df_indkomst_kommuner
+       .loc[:, ["kommune_id", "kommune"]]
+       .drop_duplicates()
+       .rename(columns = {'kommune': 'municipality_name'})
+       .sort_values('municipality_name')
+    )
+
+def wrangle_g_indkomst(df_indkomst_kommuner):
+    df_kommuner_g_indkomst = (df_indkomst_kommuner
+       .loc[:, ["decil gennemsnit", "kommune_id", "kommune", "tid", "value"]]
+       .rename(columns = {'tid': 'year',
+                          'decil gennemsnit': 'decile_group',
+                          'value': 'avg_income',
+                          'kommune': 'municipality_name'})
+    )
 
-df_kommuner_g_indkomst["year"] = pd.to_numeric(df_kommuner_g_indkomst["year"])
+    df_kommuner_g_indkomst["year"] = pd.to_numeric(df_kommuner_g_indkomst["year"])
 
-df_kommuner_g_indkomst['decile_group'] = df_kommuner_g_indkomst['decile_group'].astype(str) + 'e'
+    df_kommuner_g_indkomst['decile_group'] = df_kommuner_g_indkomst['decile_group'].astype(str) + 'e'
 
-df_kommuner_g_lavindkomst = (df_n_lavindkomst_kommuner
-   .loc[(kun_kommuner) & (~regioner), ["kommune", "tid", "value"]]
-   .merge(df_pct_lavindkomst_kommuner, on = ['kommune', 'tid'])
-   .rename(columns = {'kommune': 'municipality_name',
-                      'tid': 'year',
-                      'indkomstniveau ': 'income_level',
-                      'value_x': 'n_lowincome',
-                      'value_y': 'p_lowincome'})
-   .drop(labels ="Indhold", axis = 1)
-)
+    return df_kommuner_g_indkomst
 
-df_kommuner_g_lavindkomst["year"] = pd.to_numeric(df_kommuner_g_lavindkomst["year"])
+def wrangle_g_lavindkomst(df_n_lavindkomst_kommuner, df_pct_lavindkomst_kommuner, df_kommuner):
+    df_kommuner_g_lavindkomst = (df_n_lavindkomst_kommuner
+       .loc[:, ["KOMMUNEDK", "Tid", "value"]]
+       .merge(df_pct_lavindkomst_kommuner, on = ['KOMMUNEDK', 'Tid'])
+       .rename(columns = {'KOMMUNEDK': 'kommune_id',
+                          'Tid': 'year',
+                          'INDKN': 'income_level',
+                          'value_x': 'n_lowincome',
+                          'value_y': 'p_lowincome'})
+       .drop(labels = "ContentsCode", axis = 1)
+       .merge(df_kommuner, on = 'kommune_id')
+    )
 
-df_kommuner_g_lavindkomst["income_level"] = 50
+    df_kommuner_g_lavindkomst["year"] = pd.to_numeric(df_kommuner_g_lavindkomst["year"])
+
+    df_kommuner_g_lavindkomst["income_level"] = 50
+
+    return df_kommuner_g_lavindkomst
+
+@st.cache(allow_output_mutation = True, show_spinner = False)
+def load_data():
+    ## Import data from dst (concurrently), with the area codes as integers
+    data = run({
+        'indkomst_kommuner': Source(query_indkomst_kommuner, naming = 'label',
+                                    codes = {'KOMMUNEDK': 'kommune_id'}),
+        'pct_lavindkomst_kommuner': Source(query_pct_lavindkomst_kommuner, codes = {'KOMMUNEDK': 'KOMMUNEDK'}),
+        'n_lavindkomst_kommuner': Source(query_n_lavindkomst_kommuner, codes = {'KOMMUNEDK': 'KOMMUNEDK'}),
+
+        'kommuner': Transform(wrangle_kommuner, 'indkomst_kommuner'),
+        'g_indkomst': Transform(wrangle_g_indkomst, 'indkomst_kommuner'),
+        'g_lavindkomst': Transform(wrangle_g_lavindkomst,
+                                   'n_lavindkomst_kommuner', 'pct_lavindkomst_kommuner', 'kommuner'),
+    })
+
+    df_kommuner = data['kommuner']
+
+    return (freeze(data['g_indkomst']),
+            freeze(data['g_lavindkomst']),
+            row_positions(data['g_indkomst'], 'kommune_id'),
+            row_positions(data['g_lavindkomst'], 'kommune_id'),
+            MappingProxyType(dict(zip(df_kommuner['kommune_id'], df_kommuner['municipality_name']))))
+
+(df_kommuner_g_indkomst,
+ df_kommuner_g_lavindkomst,
+ rows_g_indkomst,
+ rows_g_lavindkomst,
+ municipality_names) = load_data()
+
+## New frames sharing the read-only arrays - no data is copied
+df_kommuner_g_indkomst = df_kommuner_g_indkomst.copy(deep = False)
+df_kommuner_g_lavindkomst = df_kommuner_g_lavindkomst.copy(deep = False)
+
+# Figure payloads
+
+## Every rerun sends the figures to the browser as JSON. slim_figure removes what the
+## browser does not need before a figure is shown: customdata that is the same for all
+## points of a trace, or repeats x or y, is written into the hover template instead,
+## numbers are rounded to the precision they are shown with, and the plotly template is
+## cut down to the parts used by 2D line and bar charts.
+## Run streamlit with --logger.level=debug to see the size of each figure before and after.
+logger = get_logger(__name__)
+
+template_layout = ['annotationdefaults', 'autotypenumbers', 'colorway', 'font', 'hoverlabel',
+                   'hovermode', 'paper_bgcolor', 'plot_bgcolor', 'title', 'xaxis', 'yaxis']
+
+def figure_size(fig):
+    """Size in bytes of the figure as serialized by st.plotly_chart."""
+    return len(json.dumps(fig.to_dict(), cls = PlotlyJSONEncoder))
+
+def rounded(values, decimals):
+    """Numbers rounded to decimals - as integers if they are whole - and other values unchanged."""
+    try:
+        numbers = np.round(np.asarray(values, dtype = float), decimals)
+    except (TypeError, ValueError):
+        return np.asarray(values, dtype = object)
+    if np.all(numbers == np.floor(numbers)):
+        return numbers.astype(np.int64)
+    return numbers
+
+def reference(axis, values, decimals):
+    """Hover template reference to x or y, formatted like the rounded values."""
+    if values.dtype.kind == 'i':
+        return '%{' + axis + ':.0f}'
+    if values.dtype.kind == 'f':
+        return '%{' + axis + ':.' + str(decimals) + 'f}'
+    return '%{' + axis + '}'
+
+def slim_trace(trace, decimals):
+    axes = {}
+    for axis in ('x', 'y'):
+        if trace[axis] is not None:
+            axes[axis] = rounded(trace[axis], decimals)
+            ## plotly ignores assignments of equal values, so whole floats would stay floats
+            trace[axis] = None
+            trace[axis] = axes[axis]
+
+    def replacement(values):
+        for axis, axis_values in axes.items():
+            if len(values) == len(axis_values) and np.all(values == axis_values):
+                return reference(axis, axis_values, decimals)
+        if len(values) and np.all(values == values[0]):
+            return str(values[0])
+        return None
+
+    if trace.customdata is not None and trace.hovertemplate:
+        customdata = np.asarray(trace.customdata, dtype = object)
+        hovertemplate = trace.hovertemplate
+        kept = []
+        for i in range(customdata.shape[1]):
+            column = rounded(customdata[:, i], decimals)
+            value = replacement(column)
+            if value is None:
+                value = '%{customdata[' + str(len(kept)) + ']}'
+                kept.append(column.tolist())
+            hovertemplate = hovertemplate.replace('%{customdata[' + str(i) + ']}', value)
+        trace.hovertemplate = hovertemplate
+        trace.customdata = list(zip(*kept)) if kept else None
+
+    if trace['text'] is not None and trace['texttemplate'] and '%{text}' in trace.texttemplate:
+        value = replacement(rounded(trace.text, decimals))
+        if value is not None:
+            trace.texttemplate = trace.texttemplate.replace('%{text}', value)
+            trace.text = None
+
+def slim_figure(fig, decimals):
+    """Shrink the JSON of a figure, showing numbers with the given number of decimals."""
+    size = figure_size(fig) if logger.isEnabledFor(logging.DEBUG) else None
+
+    for trace in fig.data:
+        slim_trace(trace, decimals)
+
+    template = fig.layout.template.to_plotly_json()
+    trace_types = {trace.type for trace in fig.data}
+    fig.layout.template = {
+        'data': {k: v for k, v in template.get('data', {}).items() if k in trace_types},
+        'layout': {k: v for k, v in template.get('layout', {}).items() if k in template_layout}
+    }
+
+    if size is not None:
+        logger.debug('Figure payload reduced from %d to %d bytes', size, figure_size(fig))
+    return fig
 
 # Dashboard title
 st.title('Economic inequality in Danish municipalities')
@@ -190,11 +225,11 @@ low-income families in each municipality in Denmark.
 """)
 
 # Create drop down box where the user can select municipality
-municipalities = df_kommuner_g_indkomst['municipality_name'].drop_duplicates().sort_values().tolist()
-
+## The options are municipality codes (sorted by name), shown by name
 municipality_category = st.selectbox(
     'Choose municipality:', 
-    municipalities 
+    list(municipality_names),
+    format_func = municipality_names.get
     )
 
 st.header("Income inequality")
@@ -208,9 +243,7 @@ with the highest income are in the 10. decile.
 """)
 
 # Create line plot with average income grouped by decile
-chosen_filter = df_kommuner_g_indkomst['municipality_name'] == municipality_category
-
-df_g_indkomst_filtered = df_kommuner_g_indkomst[(chosen_filter)]
+df_g_indkomst_filtered = df_kommuner_g_indkomst.iloc[rows_g_indkomst[municipality_category]]
 
 color_scale = {'1. decile': 'rgb(196, 201, 242)', '2. decile': 'rgb(182, 188, 239)', 
                '3. decile': 'rgb(167, 175, 235)', '4. decile': 'rgb(151, 163, 232)',
@@ -330,6 +363,8 @@ st.markdown("""Income is in Danish kroner""")
 config = {'displayModeBar': False, 'scrollZoom': False}
 
 ## Show plot
+slim_figure(fig_indkomst, decimals = 0)
+
 st.plotly_chart(fig_indkomst, use_container_width=True, config=config)
 
 # Share of people living in low-income families
@@ -343,9 +378,7 @@ a total income lower than 50 percent of the median income for households in Denm
 
 # Create line plot with share of people living in low income families
 
-chosen_filter_lav = df_kommuner_g_lavindkomst['municipality_name'] == municipality_category
-
-df_g_lavindkomst_filtered = df_kommuner_g_lavindkomst[(chosen_filter_lav)]
+df_g_lavindkomst_filtered = df_kommuner_g_lavindkomst.iloc[rows_g_lavindkomst[municipality_category]]
 
 fig_lavindkomst = px.line(
   df_g_lavindkomst_filtered,
@@ -428,6 +461,8 @@ fig_lavindkomst.update_layout(
 ## Plot title
 st.subheader('Figure 2: Share of the population living in a low-income family')
 
+slim_figure(fig_lavindkomst, decimals = 1)
+
 st.plotly_chart(fig_lavindkomst, use_container_width=True, config=config)
 
 # Share of the population living in a low-income family
@@ -521,4 +556,6 @@ fig_top5.update_traces(
 ## Plot title
 st.subheader('Figure 3: Municipalities with largest share living in a low-income family')
 
+slim_figure(fig_top5, decimals = 1)
+
 st.plotly_chart(fig_top5, use_container_width=True, config=config)
@@ -1,212 +1,44 @@
 # Import data from dst, wrangle it and load it into postgres
+#
+# The tables are declared in a catalog (see statbank_pipeline.py): where each
+# one comes from, how it is wrangled and the table it is loaded into. Tasks whose
+# inputs have not changed since the last run are skipped, using the state kept in
+# .pipeline_state next to this script.
 
 # Modules
-import pandas as pd
-import requests
-from pyjstat import pyjstat
 import os
-from  sqlalchemy import (create_engine, MetaData, Table, Column, String, Integer, 
-                         SmallInteger, Float, insert, delete, select, ForeignKey)
-
-# Import data from dst
-
-## URL til tabel med folketal
-url_dst = 'https://api.statbank.dk/v1/data'
-
-## Parameters for the API
-query_indkomst_kommuner = {
-   "table": "IFOR32",
-   "format": "JSONSTAT",
-   "valuePresentation": "CodeAndValue",
-   "variables": [
-      {
-         "code": "DECILGEN",
-         "values": [
-            "*"
-         ]
-      },
-      {
-         "code": "KOMMUNEDK",
-         "values": [
-            "*"
-         ]
-      },
-      {
-         "code": "Tid",
-         "values": [
-            "(-n+10)"
-         ]
-      }
-   ]
-}
-
-query_pct_lavindkomst_kommuner = {
-   "table": "IFOR12P",
-   "format": "JSONSTAT",
-   "valuePresentation": "CodeAndValue",
-   "variables": [
-      {
-         "code": "KOMMUNEDK",
-         "values": [
-            "*"
-         ]
-      },
-      {
-         "code": "INDKN",
-         "values": [
-            "50"
-         ]
-      },
-      {
-         "code": "Tid",
-         "values": [
-            "(-n+10)"
-         ]
-      }
-   ]
-}
-
-query_n_lavindkomst_kommuner = {
-   "table": "IFOR12A",
-   "format": "JSONSTAT",
-   "valuePresentation": "CodeAndValue",
-   "variables": [
-      {
-         "code": "KOMMUNEDK",
-         "values": [
-            "*"
-         ]
-      },
-      {
-         "code": "INDKN",
-         "values": [
-            "50"
-         ]
-      },
-      {
-         "code": "Tid",
-         "values": [
-            "(-n+10)"
-         ]
-      }
-   ]
-}
-
-query_folketal = {
-   "table": "FOLK1A",
-   "format": "JSONSTAT",
-   "valuePresentation": "CodeAndValue",
-   "variables": [
-      {
-         "code": "OMRÅDE",
-         "values": [
-            "*"
-         ]
-      },
-      {
-         "code": "Tid",
-         "values": [
-            "*K1"
-         ]
-      },
-      {
-         "code": "Tid",
-         "values": [
-            "(-n+10)"
-         ]
-      }
-   ]
-}
-
-## Post query
-r_indkomst_kommuner = requests.post(url_dst, json = query_indkomst_kommuner)
-
-r_pct_lavindkomst_kommuner = requests.post(url_dst, json = query_pct_lavindkomst_kommuner)
-
-r_n_lavindkomst_kommuner = requests.post(url_dst, json = query_n_lavindkomst_kommuner)
-
-r_folketal = requests.post(url_dst, json = query_folketal)
-
-## Read JSON-stat result
-ds_indkomst_kommuner = pyjstat.Dataset.read(r_indkomst_kommuner.text)
-
-ds_pct_lavindkomst_kommuner = pyjstat.Dataset.read(r_pct_lavindkomst_kommuner.text)
-
-ds_n_lavindkomst_kommuner = pyjstat.Dataset.read(r_n_lavindkomst_kommuner.text)
-
-ds_folketal = pyjstat.Dataset.read(r_folketal.text)
-
-## Write to pandas dataframe
-df_indkomst_kommuner = ds_indkomst_kommuner.write('dataframe', naming = 'id')
-
-df_pct_lavindkomst_kommuner = ds_pct_lavindkomst_kommuner.write('dataframe', naming = 'id')
-
-df_n_lavindkomst_kommuner = ds_n_lavindkomst_kommuner.write('dataframe', naming = 'id')
-
-df_folketal_tekst = ds_folketal.write('dataframe', naming = 'label')
-df_folketal_kode = ds_folketal.write('dataframe', naming = 'id')
-df_folketal_tekst['id'] = df_folketal_kode['OMRÅDE']
+import sys
+from pathlib import Path
+import pandas as pd
+from  sqlalchemy import (create_engine, inspect, MetaData, Table, Column, String, Integer,
+                         Float, ForeignKey)
 
-# Data cleaning and wrangling
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from statbank_pipeline import (Source, Values, Transform, Target, run, er_land, er_region, er_kommune,
+                               query_indkomst_kommuner, query_pct_lavindkomst_kommuner,
+                               query_n_lavindkomst_kommuner, query_folketal)
 
-kun_kommuner = df_folketal_tekst["område"] != "Hele landet"
-regioner = df_folketal_tekst["område"].map(lambda x: x.startswith('Region'))
-
-df_kommuner = (df_folketal_tekst
-   .loc[(kun_kommuner) & (~regioner), ["område", "id"]]
-   .drop_duplicates()
-   .rename(columns = {'område': 'kommune_navn'})
-)
-
-df_kommuner_folketal = (df_folketal_tekst
-   .loc[(kun_kommuner) & (~regioner), ["tid", "value", "id"]]
-   .assign(år = lambda x: x.tid.str.slice(stop = 4),
-           kvartal = lambda x: x.tid.str.slice(start = 4))
-   .query('kvartal not in ["K2", "K3", "K4"]')
-   .loc[:, ["id", "år", "kvartal", "value"]]
-   .rename(columns = {'value': 'folketal',
-                      'id': 'kommune_id'})
-)
-
-df_kommuner_g_indkomst = (df_indkomst_kommuner
-   .merge(df_kommuner, left_on = 'KOMMUNEDK', right_on = 'id')
-   .rename(columns = {'KOMMUNEDK': 'kommune_id',
-                      'Tid': 'år',
-                      'DECILGEN': 'decil_gruppe',
-                      'value': 'g_indkomst'})
-   .loc[:, ["kommune_id", "år", "decil_gruppe", "g_indkomst"]]
-)
-
-df_kommuner_g_lavindkomst = (df_n_lavindkomst_kommuner
-   .loc[:, ["KOMMUNEDK", "Tid", "value"]]
-   .merge(df_pct_lavindkomst_kommuner, on = ['KOMMUNEDK', 'Tid'])
-   .merge(df_kommuner, left_on = 'KOMMUNEDK', right_on = 'id')
-   .loc[:, ["id", "Tid", "INDKN", "value_x", "value_y"]]
-   .rename(columns = {'id': 'kommune_id',
-                      'Tid': 'år',
-                      'INDKN': 'lavindkomst_niveau',
-                      'value_x': 'n_lavindkomst',
-                      'value_y': 'p_lavindkomst'})
-)
-
-# create tables in the ulighed_kommuner database
+state_dir = Path(__file__).resolve().parent / '.pipeline_state'
 
-engine = create_engine(os.environ['DATABASE_URI'])
-
-connection = engine.connect()
+# Tables in the ulighed_kommuner database
 
 metadata = MetaData()
 
+regioner = Table('regioner', metadata,
+      Column('id', Integer(), primary_key = True, nullable = False),
+      Column('region_navn', String(64), nullable = False, unique = True))
+
 kommuner = Table('kommuner', metadata,
       Column('id', Integer(), primary_key = True, nullable = False),
-      Column('kommune_navn', String(64), nullable = False, unique = True))
+      Column('kommune_navn', String(64), nullable = False, unique = True),
+      Column('region_id', Integer(), ForeignKey("regioner.id"), nullable = False))
 
 kommuner_folketal = Table('kommuner_folketal', metadata,
       Column('kommune_id', Integer(), ForeignKey("kommuner.id"), primary_key = True),
       Column('år', Integer(), primary_key = True),
       Column('kvartal', String(32), nullable = False),
       Column('folketal', Float(), nullable = False))
-      
+
 kommuner_g_indkomst = Table('kommuner_g_indkomst', metadata,
       Column('kommune_id', Integer(), ForeignKey("kommuner.id"), primary_key = True),
       Column('år', Integer(), primary_key = True),
@@ -220,18 +52,187 @@ kommuner_g_lavindkomst = Table('kommuner_g_lavindkomst', metadata,
       Column('n_lavindkomst', Float(), nullable = False),
       Column('p_lavindkomst', Float(), nullable = False))
 
-metadata.create_all(engine)
+regioner_g_indkomst = Table('regioner_g_indkomst', metadata,
+      Column('region_id', Integer(), ForeignKey("regioner.id"), primary_key = True),
+      Column('år', Integer(), primary_key = True),
+      Column('decil_gruppe', String(32), primary_key = True),
+      Column('g_indkomst', Float(), nullable = False))
+
+regioner_g_lavindkomst = Table('regioner_g_lavindkomst', metadata,
+      Column('region_id', Integer(), ForeignKey("regioner.id"), primary_key = True),
+      Column('år', Integer(), primary_key = True),
+      Column('lavindkomst_niveau', String(32), nullable = False),
+      Column('n_lavindkomst', Float(), nullable = False),
+      Column('p_lavindkomst', Float(), nullable = False))
+
+# Data cleaning and wrangling
 
-# delete all the rows in the tables (if this script has already been run)
-delete_kommuner = connection.execute(delete(kommuner))
-delete_kommuner_folketal = connection.execute(delete(kommuner_folketal))
-delete_kommuner_g_indkomst = connection.execute(delete(kommuner_g_indkomst))
-delete_kommuner_g_lavindkomst = connection.execute(delete(kommuner_g_lavindkomst))
+def områder(df_område):
+  """Areas of StatBank, with the level of each area and the region of each municipality."""
+  område_id = df_område['id'].to_numpy()
+
+  ## StatBank lists each region followed by its municipalities, so the region of
+  ## a municipality is the nearest region above it
+  df_områder = df_område.assign(
+    er_land = er_land(område_id),
+    er_region = er_region(område_id),
+    er_kommune = er_kommune(område_id),
+    region_id = df_område['id'].where(er_region(område_id)).ffill())
+
+  ## Check that order, as otherwise municipalities would silently get the wrong region
+  kommuner_uden_region = df_områder['er_kommune'] & df_områder['region_id'].isna()
+  regioner_uden_kommuner = (set(df_områder.loc[df_områder['er_region'], 'id'])
+                            - set(df_områder.loc[df_områder['er_kommune'], 'region_id']))
+  if kommuner_uden_region.any() or regioner_uden_kommuner:
+    raise ValueError('Areas are not listed as regions each followed by their municipalities: '
+                     '{} municipalities before the first region, regions without municipalities: {}'.format(
+                       kommuner_uden_region.sum(), sorted(regioner_uden_kommuner)))
+
+  return df_områder
+
+def wrangle_kommuner(df_områder):
+  return (df_områder
+     .loc[df_områder['er_kommune'], ["område", "id", "region_id"]]
+     .drop_duplicates()
+     .rename(columns = {'område': 'kommune_navn'})
+     .astype({'region_id': int})
+  )
+
+## Hele landet is stored as a region containing all municipalities
+def wrangle_regioner(df_områder):
+  return (df_områder
+     .loc[df_områder['er_land'] | df_områder['er_region'], ["område", "id"]]
+     .drop_duplicates()
+     .rename(columns = {'område': 'region_navn'})
+  )
+
+## Only municipalities and the first quarter are fetched
+def wrangle_kommuner_folketal(df_folketal):
+  return (df_folketal
+     .assign(år = lambda x: x.tid.str.slice(stop = 4),
+             kvartal = lambda x: x.tid.str.slice(start = 4))
+     .loc[:, ["id", "år", "kvartal", "value"]]
+     .rename(columns = {'value': 'folketal',
+                        'id': 'kommune_id'})
+  )
+
+def wrangle_kommuner_g_indkomst(df_indkomst_kommuner, df_kommuner):
+  return (df_indkomst_kommuner
+     .merge(df_kommuner, left_on = 'KOMMUNEDK', right_on = 'id')
+     .rename(columns = {'KOMMUNEDK': 'kommune_id',
+                        'Tid': 'år',
+                        'DECILGEN': 'decil_gruppe',
+                        'value': 'g_indkomst'})
+     .loc[:, ["kommune_id", "år", "decil_gruppe", "g_indkomst"]]
+  )
+
+def wrangle_kommuner_g_lavindkomst(df_n_lavindkomst_kommuner, df_pct_lavindkomst_kommuner, df_kommuner):
+  return (df_n_lavindkomst_kommuner
+     .loc[:, ["KOMMUNEDK", "Tid", "value"]]
+     .merge(df_pct_lavindkomst_kommuner, on = ['KOMMUNEDK', 'Tid'])
+     .merge(df_kommuner, left_on = 'KOMMUNEDK', right_on = 'id')
+     .loc[:, ["id", "Tid", "INDKN", "value_x", "value_y"]]
+     .rename(columns = {'id': 'kommune_id',
+                        'Tid': 'år',
+                        'INDKN': 'lavindkomst_niveau',
+                        'value_x': 'n_lavindkomst',
+                        'value_y': 'p_lavindkomst'})
+  )
+
+# Population-weighted rollup to regions and the whole country
+
+## Every municipality is listed twice - under its region and under Hele landet - so
+## all regions, years and deciles are aggregated in a single groupby
+def kommuner_regioner(df_kommuner):
+  return (pd.concat([df_kommuner.loc[:, ["id", "region_id"]],
+                     df_kommuner.loc[:, ["id"]].assign(region_id = 0)])
+     .rename(columns = {'id': 'kommune_id'})
+  )
+
+def vægtet(df, df_kommuner_folketal, df_kommuner_regioner):
+  """Rows of df with the population of their municipality and year, once for each region it is in."""
+  df_vægtet = df.merge(df_kommuner_folketal.loc[:, ["kommune_id", "år", "folketal"]],
+                       on = ['kommune_id', 'år'], how = 'left', validate = 'many_to_one')
+
+  ## A municipality without a weight would silently drop out of its region
+  mangler = df_vægtet.loc[df_vægtet['folketal'].isna(), ["kommune_id", "år"]].drop_duplicates()
+  if len(mangler):
+    raise ValueError('No population for {} municipality-years, e.g. {}'.format(
+      len(mangler), mangler.head().to_dict('records')))
+
+  return df_vægtet.merge(df_kommuner_regioner, on = 'kommune_id')
+
+def wrangle_regioner_g_indkomst(df_kommuner_g_indkomst, df_kommuner_folketal, df_kommuner_regioner):
+  return (vægtet(df_kommuner_g_indkomst, df_kommuner_folketal, df_kommuner_regioner)
+     .assign(g_indkomst = lambda x: x.g_indkomst * x.folketal)
+     .groupby(['region_id', 'år', 'decil_gruppe'], as_index = False)[['g_indkomst', 'folketal']]
+     .sum()
+     .assign(g_indkomst = lambda x: x.g_indkomst / x.folketal)
+     .loc[:, ["region_id", "år", "decil_gruppe", "g_indkomst"]]
+  )
+
+## Counts of people are summed, shares are weighted by population
+def wrangle_regioner_g_lavindkomst(df_kommuner_g_lavindkomst, df_kommuner_folketal, df_kommuner_regioner):
+  return (vægtet(df_kommuner_g_lavindkomst, df_kommuner_folketal, df_kommuner_regioner)
+     .assign(p_lavindkomst = lambda x: x.p_lavindkomst * x.folketal)
+     .groupby(['region_id', 'år', 'lavindkomst_niveau'], as_index = False)[['n_lavindkomst', 'p_lavindkomst', 'folketal']]
+     .sum()
+     .assign(p_lavindkomst = lambda x: x.p_lavindkomst / x.folketal)
+     .loc[:, ["region_id", "år", "lavindkomst_niveau", "n_lavindkomst", "p_lavindkomst"]]
+  )
+
+# Catalog of the pipeline
+
+catalog = {
+  ## Import data from dst, with the area codes as integers, and the areas from the
+  ## metadata of the population table
+  'indkomst_kommuner': Source(query_indkomst_kommuner, codes = {'KOMMUNEDK': 'KOMMUNEDK'}),
+  'pct_lavindkomst_kommuner': Source(query_pct_lavindkomst_kommuner, codes = {'KOMMUNEDK': 'KOMMUNEDK'}),
+  'n_lavindkomst_kommuner': Source(query_n_lavindkomst_kommuner, codes = {'KOMMUNEDK': 'KOMMUNEDK'}),
+  'folketal': Source(query_folketal, naming = 'label', codes = {'OMRÅDE': 'id'}),
+
+  'område': Values('FOLK1A', 'OMRÅDE'),
+
+  'områder': Transform(områder, 'område'),
+  'kommuner_regioner': Transform(kommuner_regioner, 'kommuner'),
+
+  ## Tables in postgres
+  'regioner': Target(regioner, wrangle_regioner, 'områder'),
+  'kommuner': Target(kommuner, wrangle_kommuner, 'områder'),
+  'kommuner_folketal': Target(kommuner_folketal, wrangle_kommuner_folketal, 'folketal'),
+  'kommuner_g_indkomst': Target(kommuner_g_indkomst, wrangle_kommuner_g_indkomst,
+                                'indkomst_kommuner', 'kommuner'),
+  'kommuner_g_lavindkomst': Target(kommuner_g_lavindkomst, wrangle_kommuner_g_lavindkomst,
+                                   'n_lavindkomst_kommuner', 'pct_lavindkomst_kommuner', 'kommuner'),
+  'regioner_g_indkomst': Target(regioner_g_indkomst, wrangle_regioner_g_indkomst,
+                                'kommuner_g_indkomst', 'kommuner_folketal', 'kommuner_regioner'),
+  'regioner_g_lavindkomst': Target(regioner_g_lavindkomst, wrangle_regioner_g_lavindkomst,
+                                   'kommuner_g_lavindkomst', 'kommuner_folketal', 'kommuner_regioner'),
+}
 
-# Load data to tables in postgres
-df_kommuner.to_sql(name="kommuner", con=connection, if_exists="append", index=False)
-df_kommuner_folketal.to_sql(name="kommuner_folketal", con=connection, if_exists="append", index=False)
-df_kommuner_g_indkomst.to_sql(name="kommuner_g_indkomst", con=connection, if_exists="append", index=False)
-df_kommuner_g_lavindkomst.to_sql(name="kommuner_g_lavindkomst", con=connection, if_exists="append", index=False)
+# Run the pipeline and load the changed tables into postgres
+
+engine = create_engine(os.environ['DATABASE_URI'])
 
-connection.close() 
+## create_all does not change tables that already exist, so a table created before a
+## column was added (e.g. kommuner.region_id) has to be dropped and created again
+def check_columns(engine, metadata):
+  inspector = inspect(engine)
+  existing = set(inspector.get_table_names())
+  for table in metadata.sorted_tables:
+    if table.name not in existing:
+      continue
+    missing = set(table.c.keys()) - {column['name'] for column in inspector.get_columns(table.name)}
+    if missing:
+      ## The table can only be dropped together with the tables referencing it
+      drop = [table]
+      for t in metadata.sorted_tables:
+        if any(fk.column.table in drop for fk in t.foreign_keys):
+          drop.append(t)
+      raise ValueError('Table {} has no column {}. Drop the tables {} and run the import again, '
+                       'they are then created and loaded anew'.format(
+                         table.name, ', '.join(sorted(missing)), ', '.join(t.name for t in reversed(drop))))
+
+check_columns(engine, metadata)
+
+run(catalog, engine = engine, state_dir = state_dir)
@@ -1,15 +1,15 @@
-# Import data from postgres, perform data validation and EDA, and create visualizations
+# Validate the data in postgres
+#
+# The checks are compiled to SQL and run inside postgres, so only the number of
+# violations and a few sample rows are sent to the client, no matter how big the tables are.
 
 # Modules
-import pandas as pd
-import numpy as np
-import plotly.express as px
-import plotly.graph_objects as go
 import os
-from sqlalchemy import (create_engine, MetaData, Table, select)
-import pandera as pa
+import pandas as pd
+from sqlalchemy import (create_engine, MetaData, Table, select, union, func, and_, or_, true,
+                        Integer, String, Float)
 
-# Import data from postgres
+# Connect to postgres
 
 ## create connection to postgres and create metadata object
 engine = create_engine(os.environ['DATABASE_URI'])
@@ -19,6 +19,8 @@ connection = engine.connect()
 metadata = MetaData()
 
 ## create sqlalchemy table objects
+regioner = Table('regioner', metadata, autoload = True, autoload_with = engine)
+
 kommuner = Table('kommuner', metadata, autoload = True, autoload_with = engine)
 
 kommuner_folketal = Table('kommuner_folketal', metadata, autoload = True, autoload_with = engine)
@@ -27,56 +29,177 @@ kommuner_g_indkomst = Table('kommuner_g_indkomst', metadata, autoload = True, au
 
 kommuner_g_lavindkomst = Table('kommuner_g_lavindkomst', metadata, autoload = True, autoload_with = engine)
 
-## fetch data from postgres
-
-def fetch_data(table_name):
-  fetch_table = connection.execute(select([table_name])).fetchall()
-  df = pd.DataFrame(fetch_table)
-  df.columns = fetch_table[0].keys()
-  return df
+regioner_g_indkomst = Table('regioner_g_indkomst', metadata, autoload = True, autoload_with = engine)
+
+regioner_g_lavindkomst = Table('regioner_g_lavindkomst', metadata, autoload = True, autoload_with = engine)
+
+# Expected schemas (column: type), all columns are required and not nullable
+schema_regioner = {
+  'id': Integer,
+  'region_navn': String
+}
+
+schema_kommuner = {
+  'id': Integer,
+  'kommune_navn': String,
+  'region_id': Integer
+}
+
+schema_kommuner_folketal = {
+  'kommune_id': Integer,
+  'år': Integer,
+  'kvartal': String,
+  'folketal': Float
+}
+
+schema_kommuner_g_indkomst = {
+  'kommune_id': Integer,
+  'år': Integer,
+  'decil_gruppe': String,
+  'g_indkomst': Float
+}
+
+schema_kommuner_g_lavindkomst = {
+  'kommune_id': Integer,
+  'år': Integer,
+  'lavindkomst_niveau': String,
+  'n_lavindkomst': Float,
+  'p_lavindkomst': Float
+}
+
+schema_regioner_g_indkomst = {
+  'region_id': Integer,
+  'år': Integer,
+  'decil_gruppe': String,
+  'g_indkomst': Float
+}
+
+schema_regioner_g_lavindkomst = {
+  'region_id': Integer,
+  'år': Integer,
+  'lavindkomst_niveau': String,
+  'n_lavindkomst': Float,
+  'p_lavindkomst': Float
+}
+
+## Number of deciles each municipality should have per year
+n_deciles = 10
+
+## Number of violating rows to fetch as examples
+n_samples = 5
+
+## Every year with income data, from all the tables with income data, so a year that is
+## missing for every municipality in one of them is found too. kommuner_folketal is
+## checked against these years as well, as it holds the weights of the regional rollups
+år_indkomst = union(*[select([table.c.år]) for table in [kommuner_g_indkomst, kommuner_g_lavindkomst,
+                                                         regioner_g_indkomst, regioner_g_lavindkomst]]).alias('år_indkomst')
+
+## Values expected in a dimension, if not the values found in the table being checked
+expected_values = {'år': år_indkomst}
+
+# Checks
+
+results = []
+
+def check(name, violations):
+  """Run a query returning the violating rows, and record their count and a sample of them."""
+  violations = violations.alias()
+  rows = connection.execute(
+    select([violations, func.count().over().label('n_violations')]).limit(n_samples)
+  ).fetchall()
+  results.append({
+    'check': name,
+    'violations': rows[0]['n_violations'] if rows else 0,
+    'sample': [{k: v for k, v in row.items() if k != 'n_violations'} for row in rows]
+  })
+
+def check_schema(table, schema):
+  """Compare the reflected columns with the expected schema - no data is read."""
+  mismatches = []
+  for name, expected_type in schema.items():
+    if name not in table.c:
+      mismatches.append({'column': name, 'problem': 'missing'})
+    elif not isinstance(table.c[name].type, expected_type):
+      mismatches.append({'column': name, 'problem': 'type is {}, expected {}'.format(
+        table.c[name].type, expected_type.__name__)})
+  results.append({
+    'check': '{}: column types'.format(table.name),
+    'violations': len(mismatches),
+    'sample': mismatches[:n_samples]
+  })
+
+def check_not_null(table, schema):
+  """Rows with a null in any of the columns of the schema."""
+  columns = [table.c[name] for name in schema if name in table.c]
+  check('{}: nulls'.format(table.name),
+        select(columns).where(or_(*[column.is_(None) for column in columns])))
+
+def check_foreign_key(table, key = 'kommune_id', parent = kommuner):
+  """Rows (anti-join) whose key is not an id in the parent table."""
+  check('{}: {} not in {}'.format(table.name, key, parent.name),
+        select([table])
+        .select_from(table.outerjoin(parent, table.c[key] == parent.c.id))
+        .where(parent.c.id.is_(None)))
+
+def check_coverage(table, dimensions, key = 'kommune_id', parent = kommuner):
+  """Combinations of parent id and the values of dimensions that are missing.
+
+  The values are those in expected_values, or else the values found in the table.
+  """
+  expected = parent
+  columns = [parent.c.id.label(key)]
+  matches = [table.c[key] == parent.c.id]
+  for dimension in dimensions:
+    values = expected_values.get(dimension)
+    if values is None:
+      values = select([table.c[dimension]]).distinct().alias('values_' + str(len(columns)))
+    expected = expected.join(values, true())
+    columns.append(values.c[dimension])
+    matches.append(table.c[dimension] == values.c[dimension])
+  check('{}: every {} has every {}'.format(table.name, key, ' x '.join(dimensions)),
+        select(columns)
+        .select_from(expected.outerjoin(table, and_(*matches)))
+        .where(table.c[key].is_(None)))
+
+for table, schema in [(regioner, schema_regioner),
+                      (kommuner, schema_kommuner),
+                      (kommuner_folketal, schema_kommuner_folketal),
+                      (kommuner_g_indkomst, schema_kommuner_g_indkomst),
+                      (kommuner_g_lavindkomst, schema_kommuner_g_lavindkomst),
+                      (regioner_g_indkomst, schema_regioner_g_indkomst),
+                      (regioner_g_lavindkomst, schema_regioner_g_lavindkomst)]:
+  check_schema(table, schema)
+  check_not_null(table, schema)
+
+for table in [kommuner_folketal, kommuner_g_indkomst, kommuner_g_lavindkomst]:
+  check_foreign_key(table)
+
+for table in [kommuner, regioner_g_indkomst, regioner_g_lavindkomst]:
+  check_foreign_key(table, key = 'region_id', parent = regioner)
+
+check_coverage(kommuner_folketal, ['år'])
+check_coverage(kommuner_g_indkomst, ['år', 'decil_gruppe'])
+check_coverage(kommuner_g_lavindkomst, ['år'])
+check_coverage(regioner_g_indkomst, ['år', 'decil_gruppe'], key = 'region_id', parent = regioner)
+check_coverage(regioner_g_lavindkomst, ['år'], key = 'region_id', parent = regioner)
+
+## The coverage check only compares with the deciles found in the table, so count them too
+check('kommuner_g_indkomst: {} deciles'.format(n_deciles),
+      select([func.count(kommuner_g_indkomst.c.decil_gruppe.distinct()).label('n_deciles')])
+      .having(func.count(kommuner_g_indkomst.c.decil_gruppe.distinct()) != n_deciles))
 
-df_kommuner = fetch_data(kommuner)
-
-df_kommuner_folketal = fetch_data(kommuner_folketal)
+connection.close()
 
-df_kommuner_g_indkomst = fetch_data(kommuner_g_indkomst)
+# Report
+df_results = pd.DataFrame(results)
 
-df_kommuner_g_lavindkomst = fetch_data(kommuner_g_lavindkomst)
+print(df_results[['check', 'violations']].to_string(index = False))
 
-connection.close()
+for result in results:
+  if result['violations']:
+    print('\n{} - {} violations, for example:'.format(result['check'], result['violations']))
+    print(pd.DataFrame(result['sample']).to_string(index = False))
 
-# Data validation
-schema_df_kommuner = pa.DataFrameSchema({
-  'id' : pa.Column(pa.Int, nullable = False, required = True),
-  'kommune_navn' : pa.Column(pa.String, nullable = False, required = True)
-})
-
-schema_df_kommuner.validate(df_kommuner)
-
-schema_df_kommuner_folketal = pa.DataFrameSchema({
-  'kommune_id' : pa.Column(pa.Int, nullable = False, required = True),
-  'år' : pa.Column(pa.Int, nullable = False, required = True),
-  'kvartal' : pa.Column(pa.String, nullable = False, required = True),
-  'folketal' : pa.Column(pa.Float, nullable = False, required = True)
-})
-
-schema_df_kommuner_folketal.validate(df_kommuner_folketal)
-
-schema_df_kommuner_g_indkomst = pa.DataFrameSchema({
-  'kommune_id' : pa.Column(pa.Int, nullable = False, required = True),
-  'år' : pa.Column(pa.Int, nullable = False, required = True),
-  'decil_gruppe' : pa.Column(pa.String, nullable = False, required = True),
-  'g_indkomst' : pa.Column(pa.Float, nullable = False, required = True)
-})
-
-schema_df_kommuner_g_indkomst.validate(df_kommuner_g_indkomst)
-
-schema_df_kommuner_g_lavindkomst = pa.DataFrameSchema({
-  'kommune_id' : pa.Column(pa.Int, nullable = False, required = True),
-  'år' : pa.Column(pa.Int, nullable = False, required = True),
-  'lavindkomst_niveau' : pa.Column(pa.String, nullable = False, required = True),
-  'n_lavindkomst' : pa.Column(pa.Float, nullable = False, required = True),
-  'p_lavindkomst' : pa.Column(pa.Float, nullable = False, required = True)
-})
-
-schema_df_kommuner_g_lavindkomst.validate(df_kommuner_g_lavindkomst)
+if df_results['violations'].sum() > 0:
+  raise ValueError('Data validation failed: {} checks with violations'.format(
+    (df_results['violations'] > 0).sum()))
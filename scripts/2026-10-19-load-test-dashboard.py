@@ -0,0 +1,354 @@
+# Load test the streamlit dashboard with simulated concurrent sessions
+#
+# The dashboard is started locally with its StatBank requests pointed at a small
+# fixture server, so the test does not depend on (or hammer) the DST API.
+# Record the fixtures once, then replay them as often as needed:
+#
+#   python scripts/2026-10-19-load-test-dashboard.py --record
+#   python scripts/2026-10-19-load-test-dashboard.py --sessions 25 --duration 120
+#
+# Each simulated session talks to streamlit over its websocket like a browser does,
+# switches municipality and moves the year slider with a random think time in between,
+# and times every rerun. The report shows rerun latency percentiles and the CPU usage
+# and RSS of the streamlit process. A single page load is made before the sessions
+# start, so the data is loaded once and the memory each session adds on top of it is
+# reported separately - it should stay small, as sessions share the data.
+
+# Modules
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import psutil
+import requests
+import tornado.httpserver
+import tornado.web
+import tornado.websocket
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+# Settings
+
+## URL to DST's API (only used when recording fixtures)
+url_dst = 'https://api.statbank.dk/v1'
+
+dashboard_path = Path(__file__).resolve().parents[1] / '2021-03-16-streamlit-dashboard-inequality.py'
+
+fixtures_path = Path(__file__).resolve().parent / 'fixtures' / 'statbank'
+
+## Labels of the widgets in the dashboard
+label_municipality = 'Choose municipality:'
+label_year = 'Choose year:'
+
+# Replay of StatBank responses
+
+def fixture_file(fixtures, endpoint, query):
+    """Path of the fixture holding the response to a StatBank query (or metadata request)."""
+    query_hash = hashlib.sha1(json.dumps([endpoint, query], sort_keys = True).encode('utf-8')).hexdigest()[:10]
+    return Path(fixtures) / '{}-{}-{}.json'.format(query['table'], endpoint, query_hash)
+
+
+class StatbankFixtureHandler(tornado.web.RequestHandler):
+    """Answer StatBank data and metadata requests from fixtures, or record them from the real API."""
+
+    def initialize(self, fixtures, record_from):
+        self.fixtures = fixtures
+        self.record_from = record_from
+
+    def post(self, endpoint):
+        query = json.loads(self.request.body)
+        path = fixture_file(self.fixtures, endpoint, query)
+
+        if self.record_from:
+            r = requests.post('{}/{}'.format(self.record_from, endpoint), json = query)
+            r.raise_for_status()
+            path.parent.mkdir(parents = True, exist_ok = True)
+            path.write_bytes(r.content)
+            print('Recorded {} ({} bytes)'.format(path.name, len(r.content)))
+        elif not path.exists():
+            raise tornado.web.HTTPError(
+                404, 'No fixture for table {} - run with --record first'.format(query['table']))
+
+        self.set_header('Content-Type', 'application/json; charset=utf-8')
+        self.write(path.read_bytes())
+
+# Simulated browser sessions
+
+class DashboardSession:
+    """A single viewer of the dashboard, driven through streamlit's websocket protocol."""
+
+    def __init__(self, url, rng, think_time):
+        self.url = url
+        self.rng = rng
+        self.think_time = think_time
+        self.ws = None
+        self.widgets = {}    # widget label -> Selectbox/Slider proto from the last run
+        self.states = {}     # widget id -> WidgetState sent with the next rerun
+        self.messages = {}   # message hash -> ForwardMsg, to resolve cached references
+        self.latencies = []
+        self.errors = 0
+
+    async def connect(self):
+        self.ws = await tornado.websocket.websocket_connect(self.url, max_message_size = 200 * 1024 * 1024)
+
+    def close(self):
+        if self.ws is not None:
+            self.ws.close()
+
+    async def rerun(self):
+        """Ask streamlit to rerun the script and wait until the run has finished."""
+        msg = BackMsg()
+        msg.rerun_script.widget_states.widgets.extend(self.states.values())
+
+        start = time.perf_counter()
+        await self.ws.write_message(msg.SerializeToString(), binary = True)
+
+        while True:
+            payload = await self.ws.read_message()
+            if payload is None:
+                raise ConnectionError('the dashboard closed the websocket')
+
+            forward_msg = ForwardMsg()
+            forward_msg.ParseFromString(payload)
+
+            if forward_msg.WhichOneof('type') == 'ref_hash':
+                forward_msg = self.messages.get(forward_msg.ref_hash, forward_msg)
+            elif forward_msg.hash:
+                self.messages[forward_msg.hash] = forward_msg
+
+            msg_type = forward_msg.WhichOneof('type')
+
+            if msg_type == 'delta' and forward_msg.delta.WhichOneof('type') == 'new_element':
+                element = forward_msg.delta.new_element
+                element_type = element.WhichOneof('type')
+                if element_type in ('selectbox', 'slider'):
+                    widget = getattr(element, element_type)
+                    self.widgets[widget.label] = widget
+                elif element_type == 'exception':
+                    self.errors += 1
+
+            elif msg_type == 'report_finished':
+                if forward_msg.report_finished != ForwardMsg.FINISHED_SUCCESSFULLY:
+                    self.errors += 1
+                return time.perf_counter() - start
+
+    def choose_municipality(self):
+        selectbox = self.widgets[label_municipality]
+        state = WidgetState(id = selectbox.id, int_value = self.rng.randrange(len(selectbox.options)))
+        self.states[selectbox.id] = state
+
+    def choose_year(self):
+        slider = self.widgets[label_year]
+        state = WidgetState(id = slider.id)
+        state.double_array_value.data[:] = [self.rng.randint(int(slider.min), int(slider.max))]
+        self.states[slider.id] = state
+
+    def pause(self):
+        """Think time between interactions, log-normally distributed around the mean."""
+        sigma = 0.6
+        return self.rng.lognormvariate(np.log(self.think_time) - sigma ** 2 / 2, sigma)
+
+    async def run(self, deadline):
+        await self.connect()
+        try:
+            # The first run is the page load
+            self.latencies.append(await self.rerun())
+
+            while time.monotonic() < deadline:
+                await asyncio.sleep(self.pause())
+
+                # Most viewers look through municipalities, some move the year slider
+                if self.rng.random() < 0.7:
+                    self.choose_municipality()
+                else:
+                    self.choose_year()
+
+                self.latencies.append(await self.rerun())
+        finally:
+            self.close()
+
+# Resource usage of the streamlit process
+
+def process_rss(process):
+    """RSS (MB) of the process and its children."""
+    rss = 0
+    for p in [process] + process.children(recursive = True):
+        try:
+            rss += p.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return rss / 1024 ** 2
+
+
+async def sample_process(process, samples, interval):
+    """Record CPU usage (percent of one core) and RSS (MB) for the process and its children."""
+    processes = {}
+
+    while True:
+        cpu = 0.0
+        rss = 0
+        for p in [process] + process.children(recursive = True):
+            p = processes.setdefault(p.pid, p)
+            try:
+                cpu += p.cpu_percent()
+                rss += p.memory_info().rss
+            except psutil.NoSuchProcess:
+                processes.pop(p.pid, None)
+        samples.append((time.monotonic(), cpu, rss / 1024 ** 2))
+        await asyncio.sleep(interval)
+
+# Running the test
+
+def start_dashboard(port, dst_api_url):
+    env = dict(os.environ, DST_API_URL = dst_api_url)
+    return subprocess.Popen(
+        [sys.executable, '-m', 'streamlit', 'run', str(dashboard_path),
+         '--server.port', str(port),
+         '--server.headless', 'true',
+         '--server.runOnSave', 'false',
+         '--browser.gatherUsageStats', 'false'],
+        env = env,
+        stdout = subprocess.DEVNULL)
+
+
+async def wait_until_healthy(port, timeout = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get('http://localhost:{}/healthz'.format(port), timeout = 1).ok:
+                return
+        except requests.ConnectionError:
+            pass
+        await asyncio.sleep(0.5)
+    raise TimeoutError('the dashboard did not start within {} seconds'.format(timeout))
+
+
+def percentiles(values):
+    if not values:
+        return [float('nan')] * 3
+    return np.percentile(values, [50, 95, 99]).tolist()
+
+
+async def load_test(args):
+    logging.getLogger('tornado.access').setLevel(logging.WARNING)
+
+    fixture_app = tornado.web.Application([
+        (r'/v1/(data|tableinfo)', StatbankFixtureHandler,
+         dict(fixtures = Path(args.fixtures), record_from = args.record))
+    ])
+    fixture_server = tornado.httpserver.HTTPServer(fixture_app)
+    fixture_server.listen(args.fixture_port, address = '127.0.0.1')
+
+    dashboard = start_dashboard(args.port, 'http://127.0.0.1:{}/v1/data'.format(args.fixture_port))
+    samples = []
+    sampler = None
+
+    try:
+        await wait_until_healthy(args.port)
+
+        # Recording only needs a single run of the script
+        if args.record:
+            session = DashboardSession('ws://localhost:{}/stream'.format(args.port), random.Random(args.seed), args.think_time)
+            await session.run(deadline = 0)
+            return
+
+        process = psutil.Process(dashboard.pid)
+        memory = {'startup': process_rss(process)}
+
+        ## Load the data with a single page load, before any session starts
+        warm_up = DashboardSession('ws://localhost:{}/stream'.format(args.port), random.Random(args.seed - 1), args.think_time)
+        await warm_up.run(deadline = 0)
+        memory['data_loaded'] = process_rss(process)
+
+        sampler = asyncio.ensure_future(sample_process(process, samples, args.sample_interval))
+
+        # Sessions arrive over the ramp-up period and all stop at the same time
+        deadline = time.monotonic() + args.ramp_up + args.duration
+        sessions = [DashboardSession('ws://localhost:{}/stream'.format(args.port), random.Random(args.seed + i), args.think_time)
+                    for i in range(args.sessions)]
+
+        async def start_session(i, session):
+            await asyncio.sleep(args.ramp_up * i / max(args.sessions, 1))
+            await session.run(deadline)
+
+        started = time.monotonic()
+        results = await asyncio.gather(*[start_session(i, s) for i, s in enumerate(sessions)],
+                                       return_exceptions = True)
+        elapsed = time.monotonic() - started
+    finally:
+        if sampler is not None:
+            sampler.cancel()
+        dashboard.terminate()
+        dashboard.wait()
+        fixture_server.stop()
+
+    report(args, sessions, results, samples, memory, elapsed)
+
+
+def report(args, sessions, results, samples, memory, elapsed):
+    page_loads = [s.latencies[0] for s in sessions if s.latencies]
+    reruns = [latency for s in sessions for latency in s.latencies[1:]]
+    failed = [r for r in results if isinstance(r, BaseException)]
+    errors = sum(s.errors for s in sessions)
+
+    # Skip the samples from before the first session connected
+    cpu = [c for _, c, _ in samples[1:]]
+    rss = [m for _, _, m in samples[1:]]
+
+    print('Sessions:          {} ({} failed)'.format(len(sessions), len(failed)))
+    print('Duration:          {:.0f} s'.format(elapsed))
+    print('Reruns:            {} ({:.1f} per second, {} with errors)'.format(len(reruns), len(reruns) / elapsed, errors))
+    print('Page load (s):     p50 {:.3f}  p95 {:.3f}  p99 {:.3f}'.format(*percentiles(page_loads)))
+    print('Rerun latency (s): p50 {:.3f}  p95 {:.3f}  p99 {:.3f}'.format(*percentiles(reruns)))
+    if cpu:
+        print('CPU (% of a core): mean {:.0f}  max {:.0f}'.format(np.mean(cpu), np.max(cpu)))
+        print('RSS (MB):          start {:.0f}  end {:.0f}  max {:.0f}'.format(rss[0], rss[-1], np.max(rss)))
+        memory['per_session'] = (np.max(rss) - memory['data_loaded']) / max(len(sessions), 1)
+        print('Memory (MB):       at startup {:.0f}  after first page load {:.0f}  added per session {:.1f}'.format(
+            memory['startup'], memory['data_loaded'], memory['per_session']))
+    for exception in failed[:5]:
+        print('Session failed: {!r}'.format(exception))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'sessions': len(sessions),
+                'failed_sessions': len(failed),
+                'duration': elapsed,
+                'page_load_latencies': page_loads,
+                'rerun_latencies': reruns,
+                'rerun_errors': errors,
+                'process_samples': [dict(time = t, cpu_percent = c, rss_mb = m) for t, c, m in samples],
+                'memory_mb': memory,
+            }, f, indent = 2)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = 'Load test the streamlit dashboard with concurrent sessions.')
+    parser.add_argument('--sessions', type = int, default = 10, help = 'number of concurrent sessions')
+    parser.add_argument('--duration', type = float, default = 60, help = 'seconds to run after the ramp-up')
+    parser.add_argument('--ramp-up', type = float, default = 10, help = 'seconds over which sessions connect')
+    parser.add_argument('--think-time', type = float, default = 5, help = 'mean seconds between interactions')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--port', type = int, default = 8599, help = 'port for the dashboard')
+    parser.add_argument('--fixture-port', type = int, default = 8598, help = 'port for the StatBank fixture server')
+    parser.add_argument('--fixtures', default = str(fixtures_path), help = 'directory with StatBank fixtures')
+    parser.add_argument('--record', nargs = '?', const = url_dst, metavar = 'URL',
+                        help = "record fixtures from DST's API (or the API at the given URL, ending in /v1) and exit")
+    parser.add_argument('--sample-interval', type = float, default = 1, help = 'seconds between CPU/RSS samples')
+    parser.add_argument('--output', help = 'write raw latencies and samples to this JSON file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(load_test(parse_args()))
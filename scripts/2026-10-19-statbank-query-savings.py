@@ -0,0 +1,123 @@
+# Compare the StatBank queries with the queries they replaced
+#
+# The queries in statbank_pipeline.py only request the cells that are used. This script
+# fetches every table with both the previous queries (whole area dimensions) and the
+# current ones, and reports the number of cells and bytes of each. Building the queries
+# costs a request for the metadata of each table, once per run, which is counted against
+# the current queries.
+
+# Modules
+import sys
+from pathlib import Path
+import pandas as pd
+import requests
+from pyjstat import pyjstat
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from statbank_pipeline import (url_dst, table_info_text, Cells, query_indkomst_kommuner,
+                               query_pct_lavindkomst_kommuner, query_n_lavindkomst_kommuner,
+                               query_folketal)
+
+# Previous queries
+
+## As in statbank_pipeline.py before the queries were built for the cells that are used
+
+previous_indkomst_kommuner = {
+   "table": "IFOR32",
+   "format": "JSONSTAT",
+   "valuePresentation": "CodeAndValue",
+   "variables": [
+      {"code": "DECILGEN", "values": ["*"]},
+      {"code": "KOMMUNEDK", "values": ["*"]},
+      {"code": "Tid", "values": ["(-n+10)"]}
+   ]
+}
+
+previous_pct_lavindkomst_kommuner = {
+   "table": "IFOR12P",
+   "format": "JSONSTAT",
+   "valuePresentation": "CodeAndValue",
+   "variables": [
+      {"code": "KOMMUNEDK", "values": ["*"]},
+      {"code": "INDKN", "values": ["50"]},
+      {"code": "Tid", "values": ["(-n+10)"]}
+   ]
+}
+
+previous_n_lavindkomst_kommuner = {
+   "table": "IFOR12A",
+   "format": "JSONSTAT",
+   "valuePresentation": "CodeAndValue",
+   "variables": [
+      {"code": "KOMMUNEDK", "values": ["*"]},
+      {"code": "INDKN", "values": ["50"]},
+      {"code": "Tid", "values": ["(-n+10)"]}
+   ]
+}
+
+previous_folketal = {
+   "table": "FOLK1A",
+   "format": "JSONSTAT",
+   "valuePresentation": "CodeAndValue",
+   "variables": [
+      {"code": "OMRÅDE", "values": ["*"]},
+      {"code": "Tid", "values": ["*K1"]}
+   ]
+}
+
+queries = [(previous_indkomst_kommuner, query_indkomst_kommuner),
+           (previous_pct_lavindkomst_kommuner, query_pct_lavindkomst_kommuner),
+           (previous_n_lavindkomst_kommuner, query_n_lavindkomst_kommuner),
+           (previous_folketal, query_folketal)]
+
+# Fetch both versions of every table
+
+def fetch(url, body):
+  r = requests.post(url, json = body)
+  r.raise_for_status()
+  return r.text
+
+def cells(text):
+  """Number of cells in a JSON-stat result."""
+  return len(pyjstat.Dataset.read(text).write('dataframe'))
+
+rows = []
+for previous, current in queries:
+  text_previous = fetch(url_dst, previous)
+  text_current = fetch(url_dst, current.query())
+  rows.append({
+    'table': current.table,
+    'cells_before': cells(text_previous),
+    'cells_after': cells(text_current),
+    'bytes_before': len(text_previous.encode('utf-8')),
+    'bytes_after': len(text_current.encode('utf-8'))
+  })
+
+## Queries restricted to municipalities, or to years that StatBank cannot select, need the
+## metadata of their table, and of the table they take the years from
+metadata_tables = set()
+for _, query in queries:
+  if query.kommuner or (query.years and query.quarter):
+    metadata_tables.add(query.table)
+  if isinstance(query.years, Cells):
+    metadata_tables.add(query.years.table)
+rows.append({
+  'table': 'tableinfo ' + ', '.join(sorted(metadata_tables)),
+  'cells_before': 0,
+  'cells_after': 0,
+  'bytes_before': 0,
+  'bytes_after': sum(len(table_info_text(table).encode('utf-8')) for table in metadata_tables)
+})
+
+# Report
+
+df_savings = pd.DataFrame(rows)
+df_savings = (pd.concat([df_savings, df_savings.sum(numeric_only = True).to_frame().T.assign(table = 'total')])
+  .astype({column: int for column in df_savings.columns if column != 'table'})
+  .assign(
+    cells_saved = lambda x: x.cells_before - x.cells_after,
+    bytes_saved = lambda x: x.bytes_before - x.bytes_after,
+    pct_bytes_saved = lambda x: (100 * (x.bytes_before - x.bytes_after) / x.bytes_before.where(x.bytes_before > 0)).round(1))
+)
+
+print(df_savings.to_string(index = False))
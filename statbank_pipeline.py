@@ -0,0 +1,459 @@
+# Declarative ingestion of tables from Statistics Denmark's StatBank
+#
+# A catalog is a dict of named steps:
+#
+#   Source(query)                     fetch a StatBank table and decode the JSON-stat result
+#   Values(table, dimension)          the values of a dimension, from the metadata of a table
+#   Transform(function, *inputs)      a dataframe computed from the outputs of other steps
+#   Target(table, function, *inputs)  a Transform that is also loaded into a sqlalchemy table
+#
+# run() turns the catalog into a DAG of fetch -> decode -> transform -> load tasks and
+# runs independent tasks concurrently. With a state directory, the output of every task
+# is kept between runs together with a hash of it, and a task only runs again when the
+# outputs it depends on (or its own definition - the source of the module defining it
+# and of the modules of this project it uses) have changed. Fetching always runs, since
+# that is how changes in StatBank are found, and a table is only reloaded when its data
+# (or a table it references) has changed since it was loaded into the database, or when
+# it is empty.
+#
+# Transforms get the outputs of their inputs as arguments and must not modify them,
+# since the same dataframe is passed to every step that depends on it.
+
+# Modules
+import hashlib
+import inspect
+import json
+import logging
+import os
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+import pandas as pd
+import requests
+from pyjstat import pyjstat
+
+logger = logging.getLogger(__name__)
+
+## URL to DST's API (can be pointed at replayed fixtures, see scripts/*-load-test-dashboard.py)
+url_dst = os.environ.get('DST_API_URL', 'https://api.statbank.dk/v1/data')
+
+url_dst_info = url_dst.rsplit('/', 1)[0] + '/tableinfo'
+
+# Areas of StatBank
+
+## The level of an area follows from its StatBank code: 0 is the whole country,
+## 81-85 are the regions and 101 and up are the municipalities. The functions take a
+## single code or an array of codes, as integers.
+def er_land(område_id):
+    return område_id == 0
+
+def er_region(område_id):
+    return (område_id >= 81) & (område_id <= 85)
+
+def er_kommune(område_id):
+    return område_id >= 101
+
+# Table metadata
+
+## The metadata of a table is fetched at most once per run (see run()), however many
+## queries and steps use it
+_table_info = {}
+_table_info_locks = {}
+_table_info_lock = threading.Lock()
+
+def table_info_text(table):
+    """Metadata of a StatBank table as JSON: its dimensions and the codes and texts of their values."""
+    with _table_info_lock:
+        lock = _table_info_locks.setdefault(table, threading.Lock())
+    with lock:
+        if table not in _table_info:
+            _table_info[table] = _post(url_dst_info, {'table': table, 'format': 'JSON'})
+        return _table_info[table]
+
+def table_info(table):
+    return json.loads(table_info_text(table))
+
+# Queries for the StatBank tables
+#
+# Only the cells that are used are requested: municipalities only, not the regions and
+# the whole country, and only the years (and quarter) needed. The municipality codes come
+# from the metadata of each table, and the periods are picked with StatBank's own
+# selectors where possible. Run scripts/*-statbank-query-savings.py to compare the
+# queries with fetching whole dimensions.
+
+class Cells:
+    """The cells to fetch from a StatBank table, turned into a query when it is fetched.
+
+    values maps dimensions to the codes to fetch ('*' for all of them). kommuner names
+    the area dimension, which is restricted to municipality codes. years is either the
+    number of latest years to fetch (all of them if None) or another Cells, to fetch the
+    same years as that table. quarter (e.g. 'K1') picks one quarter of each year in
+    tables with quarterly data.
+    """
+
+    def __init__(self, table, values = None, kommuner = None, years = None, quarter = None):
+        self.table = table
+        self.values = values or {}
+        self.kommuner = kommuner
+        self.years = years
+        self.quarter = quarter
+
+    def periods(self):
+        """Codes (or selectors) of the time periods to fetch."""
+        if isinstance(self.years, Cells):
+            return self.period_codes()
+        if self.quarter is None:
+            return ['(-n+{})'.format(self.years)] if self.years else ['*']
+        if self.years is None:
+            return ['*' + self.quarter]
+
+        ## The latest years of a single quarter cannot be selected without the periods
+        return self.period_codes()
+
+    def period_codes(self):
+        """Codes of the time periods to fetch, from the metadata of the table."""
+        time = next(variable for variable in table_info(self.table)['variables'] if variable['time'])
+        codes = [value['id'] for value in time['values']
+                 if self.quarter is None or value['id'].endswith(self.quarter)]
+
+        if isinstance(self.years, Cells):
+            years = {code[:4] for code in self.years.period_codes()}
+            return [code for code in codes if code[:4] in years]
+        if self.years is not None:
+            return codes[-self.years:]
+        return codes
+
+    def kommune_koder(self):
+        """Codes of the municipalities in the table, in the order StatBank lists them."""
+        values = next(variable['values'] for variable in table_info(self.table)['variables']
+                      if variable['id'] == self.kommuner)
+        return [value['id'] for value in values if er_kommune(int(value['id']))]
+
+    def query(self):
+        """StatBank query for the cells."""
+        variables = [{'code': code, 'values': list(values)} for code, values in self.values.items()]
+        if self.kommuner:
+            variables.append({'code': self.kommuner, 'values': self.kommune_koder()})
+        variables.append({'code': 'Tid', 'values': self.periods()})
+
+        return {
+            'table': self.table,
+            'format': 'JSONSTAT',
+            'valuePresentation': 'CodeAndValue',
+            'variables': variables
+        }
+
+
+query_indkomst_kommuner = Cells('IFOR32', {'DECILGEN': ['*']}, kommuner = 'KOMMUNEDK', years = 10)
+
+query_pct_lavindkomst_kommuner = Cells('IFOR12P', {'INDKN': ['50']}, kommuner = 'KOMMUNEDK', years = 10)
+
+query_n_lavindkomst_kommuner = Cells('IFOR12A', {'INDKN': ['50']}, kommuner = 'KOMMUNEDK', years = 10)
+
+## Population at the start of each year, used as weights, for the years of the incomes
+query_folketal = Cells('FOLK1A', kommuner = 'OMRÅDE', years = query_indkomst_kommuner, quarter = 'K1')
+
+# Steps of a catalog
+
+class Task:
+    """A single node in the DAG: a function of the outputs of other tasks."""
+
+    def __init__(self, function, inputs = (), version = None, always = False):
+        self.function = function
+        self.inputs = tuple(inputs)
+        self.version = version if version is not None else _source(function)
+        self.always = always
+
+    def key(self, input_hashes):
+        """Hash identifying what the task computes from: its definition and its inputs."""
+        return _hash_text(json.dumps([self.version, list(input_hashes)]))
+
+
+class Source:
+    """A StatBank table, fetched with a query (a dict or Cells) and decoded to a dataframe.
+
+    naming is passed on to pyjstat ('id' or 'label'). codes maps dimensions to columns
+    that get the codes of the dimension as integers, e.g. {'KOMMUNEDK': 'kommune_id'}.
+    """
+
+    def __init__(self, query, naming = 'id', codes = None):
+        self.query = query
+        self.naming = naming
+        self.codes = codes or {}
+
+    def tasks(self, name):
+        version = json.dumps([self.query, self.naming, self.codes], sort_keys = True, default = vars)
+        return {
+            name + ':fetch': Task(self.fetch, version = version, always = True),
+            name: Task(self.decode, [name + ':fetch'], version = version + _source(Source.decode)),
+        }
+
+    def fetch(self):
+        query = self.query.query() if isinstance(self.query, Cells) else self.query
+        return _post(url_dst, query)
+
+    def decode(self, text):
+        ds = pyjstat.Dataset.read(text)
+        df = ds.write('dataframe', naming = self.naming)
+        if self.codes:
+            df_kode = df if self.naming == 'id' else ds.write('dataframe', naming = 'id')
+            for dimension, column in self.codes.items():
+                df[column] = pd.to_numeric(df_kode[dimension])
+        return df
+
+
+class Values:
+    """The values of a dimension of a StatBank table, in the order StatBank lists them.
+
+    The dataframe has the codes as integers in id and the texts in a column named after
+    the dimension, e.g. 'område'. Only the metadata of the table is fetched.
+    """
+
+    def __init__(self, table, dimension):
+        self.table = table
+        self.dimension = dimension
+
+    def tasks(self, name):
+        version = json.dumps([self.table, self.dimension])
+        return {
+            name + ':fetch': Task(self.fetch, version = version, always = True),
+            name: Task(self.decode, [name + ':fetch'], version = version + _source(Values.decode)),
+        }
+
+    def fetch(self):
+        return table_info_text(self.table)
+
+    def decode(self, text):
+        dimension = next(variable for variable in json.loads(text)['variables']
+                         if variable['id'] == self.dimension)
+        return pd.DataFrame({
+            'id': pd.to_numeric([value['id'] for value in dimension['values']]),
+            dimension['text']: [value['text'] for value in dimension['values']]
+        })
+
+
+class Transform:
+    """A dataframe computed by function from the outputs of the named inputs.
+
+    The step runs again when the source of the module defining function, or of the
+    modules of this project it uses, changes (see _source). For anything else the output
+    depends on, pass something that changes with it as version (e.g. a number to bump).
+    """
+
+    def __init__(self, function, *inputs, version = None):
+        self.function = function
+        self.inputs = inputs
+        self.version = version
+
+    def tasks(self, name):
+        return {name: Task(self.function, self.inputs, version = _source(self.function) + repr(self.version))}
+
+
+class Target(Transform):
+    """A Transform whose output is loaded into a sqlalchemy table."""
+
+    def __init__(self, table, function, *inputs, version = None):
+        super().__init__(function, *inputs, version = version)
+        self.table = table
+
+# Running a catalog
+
+def run(catalog, engine = None, state_dir = None, max_workers = 8):
+    """Run the tasks of a catalog, load its targets into engine and return the outputs.
+
+    Without a state directory every task runs. With one, unchanged tasks are skipped
+    and the outputs of skipped tasks are only returned if they were needed.
+    """
+    tasks = {}
+    for name, step in catalog.items():
+        tasks.update(step.tasks(name))
+
+    ## Metadata is fetched again in every run, like the data
+    _table_info.clear()
+
+    cache = _Cache(state_dir)
+    outputs = {}
+    hashes = {}
+
+    def output(name):
+        if name not in outputs:
+            outputs[name] = cache.output(name)
+        return outputs[name]
+
+    pending = dict(tasks)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers = max_workers) as pool:
+        while pending or running:
+            ready = [name for name, task in pending.items() if all(i in hashes for i in task.inputs)]
+
+            if not ready and not running:
+                raise ValueError('Unknown inputs or a cycle in the catalog: {}'.format(sorted(pending)))
+
+            for name in ready:
+                task = pending.pop(name)
+                key = task.key(hashes[i] for i in task.inputs)
+
+                if not task.always and cache.is_current(name, key):
+                    logger.debug('Skipping %s, its inputs have not changed', name)
+                    hashes[name] = cache.hash(name)
+                    continue
+
+                logger.debug('Running %s', name)
+
+                future = pool.submit(task.function, *[output(i) for i in task.inputs])
+                running[future] = (name, key)
+
+            # Skipped tasks may have made others ready, so check again before waiting
+            if not running or any(all(i in hashes for i in t.inputs) for t in pending.values()):
+                continue
+
+            done, _ = wait(running, return_when = FIRST_COMPLETED)
+            for future in done:
+                name, key = running.pop(future)
+                outputs[name] = future.result()
+                hashes[name] = _hash_output(outputs[name])
+                cache.store(name, key, hashes[name], outputs[name])
+
+    targets = {name: step for name, step in catalog.items() if isinstance(step, Target)}
+    if targets and engine is not None:
+        _load(targets, hashes, output, engine)
+
+    cache.save()
+    return outputs
+
+
+def _load(targets, hashes, output, engine):
+    """Replace the rows of the targets whose data changed, in a single transaction.
+
+    The hash of the data loaded into each table is kept in a pipeline_loads table in the
+    same database, and written in the same transaction as the data, so it always
+    describes what is in the database.
+    """
+    ## sqlalchemy is only needed for loading, which the dashboard does not do
+    from sqlalchemy import MetaData, Table, Column, String, select
+
+    loads = Table('pipeline_loads', MetaData(),
+        Column('table_name', String(128), primary_key = True),
+        Column('hash', String(40), nullable = False))
+
+    tables = {target.table: name for name, target in targets.items()}
+    metadata = next(iter(tables)).metadata
+    metadata.create_all(engine)
+    loads.create(engine, checkfirst = True)
+
+    with engine.begin() as connection:
+        loaded = dict(connection.execute(select([loads.c.table_name, loads.c.hash])).fetchall())
+
+        ## A table is reloaded when its data changed, or when it is empty - e.g. because
+        ## it was just created - even if the hash says it was loaded before
+        reload = {name for table, name in tables.items()
+                  if loaded.get(table.name) != hashes[name]
+                  or connection.execute(select([table]).limit(1)).first() is None}
+
+        ## Rows in a table can only be deleted when the rows referencing them are,
+        ## so tables referencing a reloaded table are reloaded too
+        changed = True
+        while changed:
+            changed = False
+            for table, name in tables.items():
+                parents = {fk.column.table for fk in table.foreign_keys}
+                if name not in reload and any(tables.get(parent) in reload for parent in parents):
+                    reload.add(name)
+                    changed = True
+
+        ordered = [table for table in metadata.sorted_tables if tables.get(table) in reload]
+
+        for table in reversed(ordered):
+            connection.execute(table.delete())
+        for table in ordered:
+            output(tables[table]).to_sql(name = table.name, con = connection, if_exists = "append", index = False)
+            connection.execute(loads.delete().where(loads.c.table_name == table.name))
+            connection.execute(loads.insert().values(table_name = table.name, hash = hashes[tables[table]]))
+
+    for table in ordered:
+        logger.info('Loaded %s', table.name)
+
+
+class _Cache:
+    """Outputs and hashes of the tasks of the previous runs, kept in state_dir."""
+
+    def __init__(self, state_dir):
+        self.dir = Path(state_dir) if state_dir else None
+        self.state = {}
+        if self.dir and (self.dir / 'state.json').exists():
+            self.state = json.loads((self.dir / 'state.json').read_text())
+
+    def _path(self, name):
+        return self.dir / (name.replace(':', '-') + '.pickle')
+
+    def is_current(self, name, key):
+        return (self.dir is not None
+                and self.state.get(name, {}).get('key') == key
+                and self._path(name).exists())
+
+    def hash(self, name):
+        return self.state.get(name, {}).get('hash')
+
+    def output(self, name):
+        with open(self._path(name), 'rb') as f:
+            return pickle.load(f)
+
+    def store(self, name, key, output_hash, output):
+        if self.dir is None:
+            return
+        self.state[name] = {'key': key, 'hash': output_hash}
+        self.dir.mkdir(parents = True, exist_ok = True)
+        with open(self._path(name), 'wb') as f:
+            pickle.dump(output, f)
+
+    def save(self):
+        if self.dir is None:
+            return
+        self.dir.mkdir(parents = True, exist_ok = True)
+        (self.dir / 'state.json').write_text(json.dumps(self.state, indent = 2))
+
+
+def _post(url, body):
+    r = requests.post(url, json = body)
+    r.raise_for_status()
+    return r.text
+
+
+def _hash_text(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _hash_output(output):
+    if isinstance(output, pd.DataFrame):
+        h = hashlib.sha1(pd.util.hash_pandas_object(output).values.tobytes())
+        h.update(repr(list(zip(output.columns, output.dtypes.astype(str)))).encode('utf-8'))
+        return h.hexdigest()
+    if isinstance(output, str):
+        return _hash_text(output)
+    return hashlib.sha1(pickle.dumps(output)).hexdigest()
+
+
+def _source(function):
+    """Source that the output of function depends on.
+
+    That is the whole module defining function - so changing a helper it calls is a
+    change too - and the modules of this project that module uses (e.g. this one, or a
+    module of helpers), found among its globals.
+    """
+    root = Path(__file__).resolve().parent
+    files = {Path(function.__code__.co_filename), Path(__file__)}
+    for value in list(function.__globals__.values()):
+        module_file = getattr(inspect.getmodule(value), '__file__', None)
+        if module_file and root in Path(module_file).resolve().parents:
+            files.add(Path(module_file))
+
+    sources = []
+    for module_file in sorted({f.resolve() for f in files}):
+        try:
+            sources.append(module_file.read_text(encoding = 'utf-8'))
+        except OSError:
+            sources.append(function.__code__.co_code.hex())
+    return ''.join(sources)